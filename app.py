@@ -1,116 +1,402 @@
 import boto3
+from botocore.config import Config
 import streamlit as st
-import json
+import orjson
+import diskcache
 from dotenv import load_dotenv
 import os
+import atexit
+import hashlib
+import html
 import logging
+import queue
+import re
 import traceback
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Optional
 
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('app.log')
-    ]
-)
+@st.cache_resource
+def _configure_logging() -> Optional[QueueListener]:
+    """
+    Route log records through a queue so console and file writes happen on a background thread.
+    Cached so Streamlit reruns skip it, and guarded so clearing the resource cache does not start
+    a second listener and rotating handler on the same log file.
+    """
+    root_logger = logging.getLogger()
+    if any(isinstance(handler, QueueHandler) for handler in root_logger.handlers):
+        return None
+
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    stream_handler = logging.StreamHandler()
+    file_handler = RotatingFileHandler('app.log', maxBytes=10_000_000, backupCount=5)
+    for handler in (stream_handler, file_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, stream_handler, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root_logger.handlers = [QueueHandler(log_queue)]
+    root_logger.setLevel(logging.INFO)
+    return listener
+
+_configure_logging()
 logger = logging.getLogger(__name__)
 
-# Load environment variables
-load_dotenv()
-logger.info("Environment variables loaded")
+@st.cache_resource
+def _bootstrap() -> None:
+    """
+    Load and validate environment variables once per process.
+    """
+    load_dotenv()
+    logger.info("Environment variables loaded")
 
-# Validate required environment variables
-required_env_vars = [
-    'AWS_REGION', 'AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY',
-    'MODEL_ID', 'KNOWLEDGE_BASE_ID', 'PRODUCT_NAME', 'APP_TITLE'
+    required_env_vars = [
+        'AWS_REGION', 'AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY',
+        'MODEL_ID', 'KNOWLEDGE_BASE_ID', 'PRODUCT_NAME', 'APP_TITLE'
+    ]
+    missing_vars = [var for var in required_env_vars if not os.getenv(var)]
+    if missing_vars:
+        error_msg = f"Missing required environment variables: {', '.join(missing_vars)}"
+        logger.error(error_msg)
+        raise ValueError(error_msg)
+
+_bootstrap()
+
+# Configuration is read once, after validation, instead of on every call
+AWS_REGION = os.environ['AWS_REGION']
+MODEL_ID = os.environ['MODEL_ID']
+KB_ID = os.environ['KNOWLEDGE_BASE_ID']
+PRODUCT_NAME = os.environ['PRODUCT_NAME']
+APP_TITLE = os.environ['APP_TITLE']
+MODEL_ARN = f"arn:aws:bedrock:{AWS_REGION}::foundation-model/{MODEL_ID}"
+BEDROCK_POOL = int(os.getenv('BEDROCK_POOL', '50'))
+
+# Latency-optimized inference mode for Nova calls ('optimized' or 'standard')
+BEDROCK_LATENCY = os.getenv('BEDROCK_LATENCY', 'optimized')
+# Marks the end of the static system prompt so Bedrock can reuse its prefill across calls
+CACHE_POINT = {"cachePoint": {"type": "default"}}
+
+# Static request configuration, built once rather than on every turn
+CLASSIFY_SYSTEM_LIST = [
+    {
+        "text": (
+            f'Classify the user input as "Product" if it is specific to {PRODUCT_NAME}, otherwise "Generic". '
+            "Reply with that one word only."
+        )
+    },
+    CACHE_POINT
 ]
-missing_vars = [var for var in required_env_vars if not os.getenv(var)]
-if missing_vars:
-    error_msg = f"Missing required environment variables: {', '.join(missing_vars)}"
-    logger.error(error_msg)
-    raise ValueError(error_msg)
+CLASSIFY_PARAMS = {
+    "max_new_tokens": 10,
+    "top_p": 0.9,
+    "top_k": 20,
+    "temperature": 0.7
+}
+GENERIC_SYS_PROMPT = os.getenv('GENERIC_SYS_PROMPT', "Answer clearly and concisely.")
+# Converse inference settings; maxTokens is chosen per query and top_k is passed through additionalModelRequestFields
+CONVERSE_PARAMS = {
+    "topP": 0.9,
+    "temperature": 0.7
+}
+# Short questions get a smaller output cap, which lowers generation latency and cost
+GENERIC_MAX_TOKENS_SHORT = int(os.getenv('GENERIC_MAX_TOKENS_SHORT', '128'))
+GENERIC_MAX_TOKENS_LONG = int(os.getenv('GENERIC_MAX_TOKENS_LONG', '512'))
+SHORT_QUERY_MAX_CHARS = 120
+# The cap is also stated in the system prompt as a word budget (about half the token cap),
+# so the model finishes its answer within the cap instead of being cut off
+GENERIC_SYSTEM_LISTS = {
+    max_tokens: [
+        {
+            "text": f"{GENERIC_SYS_PROMPT} Keep the answer under {max_tokens // 2} words."
+        },
+        CACHE_POINT
+    ]
+    for max_tokens in (GENERIC_MAX_TOKENS_SHORT, GENERIC_MAX_TOKENS_LONG)
+}
+CONVERSE_ADDITIONAL_FIELDS = {"inferenceConfig": {"topK": 20}}
+# Number of user/assistant turns kept per session, and the number sent as context with each query
+HISTORY_TURNS = int(os.getenv('HISTORY_TURNS', '40'))
+HISTORY_WINDOW_TURNS = int(os.getenv('HISTORY_WINDOW_TURNS', '6'))
+
+# Nova request bodies are serialized once, with a placeholder spliced out for the user query per call
+QUERY_PLACEHOLDER = "__QUERY__"
+QUERY_SENTINEL = orjson.dumps(QUERY_PLACEHOLDER)
+
+def _without_cache_points(blocks: list) -> list:
+    """
+    Return content or system blocks with any cache point markers removed.
+    """
+    return [block for block in blocks if 'cachePoint' not in block]
+
+def _request_template(system_list: list, inf_params: dict) -> bytes:
+    """
+    Serialize a Nova 'messages-v1' request body with a placeholder for the user query.
+    """
+    return orjson.dumps({
+        "schemaVersion": "messages-v1",
+        "messages": [{"role": "user", "content": [{"text": QUERY_PLACEHOLDER}]}],
+        "system": system_list,
+        "inferenceConfig": inf_params,
+    })
+
+def _request_templates(system_list: list, inf_params: dict) -> tuple:
+    """
+    Build the optimized (with cache point) and standard request templates for a prompt.
+    """
+    return (_request_template(system_list, inf_params),
+            _request_template(_without_cache_points(system_list), inf_params))
 
-st.title(os.getenv('APP_TITLE'))
+CLASSIFY_TEMPLATES = _request_templates(CLASSIFY_SYSTEM_LIST, CLASSIFY_PARAMS)
+
+# Product answers normally come from one 'retrieve_and_generate_stream' call. When passages were
+# retrieved speculatively while the Bedrock classifier ran, they are inlined into one Converse call instead.
+KB_SYSTEM_PROMPT = (
+    f"You answer questions about {PRODUCT_NAME} using the documentation excerpts provided. "
+    "If the excerpts do not contain the answer, say so."
+)
+KB_NUMBER_OF_RESULTS = int(os.getenv('KB_NUMBER_OF_RESULTS', '5'))
+KB_MAX_TOKENS = int(os.getenv('KB_MAX_TOKENS', '512'))
+KB_RETRIEVAL_CONFIG = {
+    'vectorSearchConfiguration': {
+        'numberOfResults': KB_NUMBER_OF_RESULTS
+    }
+}
+KB_CONFIG = {
+    'type': 'KNOWLEDGE_BASE',
+    'knowledgeBaseConfiguration': {
+        'knowledgeBaseId': KB_ID,
+        'modelArn': MODEL_ARN,
+        'retrievalConfiguration': KB_RETRIEVAL_CONFIG,
+        'generationConfiguration': {
+            'inferenceConfig': {'textInferenceConfig': {'maxTokens': KB_MAX_TOKENS}}
+        }
+    }
+}
+
+# Answers for identical queries are served from an on-disk cache shared by all sessions
+CACHE_DIR = os.getenv('CACHE_DIR', '.bedrock_cache')
+CACHE_TTL = int(os.getenv('CACHE_TTL', '86400'))
+CACHE_SIZE_LIMIT = 512_000_000
+
+# When classification needs a Bedrock call, retrieve knowledge base passages and open the generic
+# stream while it runs (the retrieval is discarded on generic turns, the generation on product turns)
+SPECULATIVE = os.getenv('SPECULATIVE') == '1'
+
+# Queries are classified locally; the Bedrock classifier is only consulted for ambiguous queries when enabled
+CLASSIFY_FALLBACK_LLM = os.getenv('CLASSIFY_FALLBACK_LLM') == '1'
+product_aliases = [alias.strip() for alias in os.getenv('PRODUCT_ALIASES', '').split(',') if alias.strip()]
+PRODUCT_RE = re.compile(
+    r'(?<!\w)(' + '|'.join(map(re.escape, [PRODUCT_NAME, *product_aliases])) + r')(?!\w)',
+    re.IGNORECASE
+)
+# Short queries that refer back to something ("how do I install it?") cannot be classified by keywords alone
+AMBIGUOUS_RE = re.compile(r'\b(it|its|this|that|these|those|they|them)\b', re.IGNORECASE)
+AMBIGUOUS_MAX_WORDS = 8
+
+st.title(APP_TITLE)
 st.subheader("Chat Interface", divider='rainbow')
 
 # Initialize session state
 if 'chat_history' not in st.session_state:
-    st.session_state.chat_history = []
+    # Bounded so long sessions do not grow memory or per-rerun cost without limit
+    st.session_state.chat_history = deque(maxlen=2 * HISTORY_TURNS)
     logger.info("Chat history initialized")
 
-# Initialize Bedrock clients
-try:
-    bedrock_runtime = boto3.client(
-        service_name='bedrock-runtime',
-        region_name=os.getenv('AWS_REGION'),
+@st.cache_resource
+def get_bedrock_clients():
+    """
+    Create the Bedrock Runtime and Agent Runtime clients from one shared session.
+    Built once per process so connection pools and credentials are reused across reruns.
+    """
+    session = boto3.Session(
+        region_name=AWS_REGION,
         aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
         aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
     )
+    client_config = Config(
+        max_pool_connections=BEDROCK_POOL,
+        retries={'mode': 'adaptive', 'max_attempts': 5},
+        tcp_keepalive=True,
+        connect_timeout=3,
+        read_timeout=60
+    )
+
+    runtime_client = session.client(service_name='bedrock-runtime', config=client_config)
     logger.info("Bedrock Runtime client initialized successfully")
 
-    bedrock_agent = boto3.client(
-        service_name='bedrock-agent-runtime',
-        region_name=os.getenv('AWS_REGION'),
-        aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-        aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
-    )
+    agent_client = session.client(service_name='bedrock-agent-runtime', config=client_config)
     logger.info("Bedrock Agent Runtime client initialized successfully")
+    return runtime_client, agent_client
+
+# Initialize Bedrock clients
+try:
+    bedrock_runtime, bedrock_agent = get_bedrock_clients()
 except Exception as e:
     error_msg = f"Failed to initialize Bedrock clients: {str(e)}"
     logger.error(error_msg)
     logger.error(traceback.format_exc())
     st.error(error_msg)
 
-def classify_query(query: str) -> str:
+@st.cache_resource
+def get_response_cache() -> diskcache.Cache:
     """
-    Classify if the query is product-specific or generic using the Amazon Nova Chat model.
+    Open the on-disk response cache once per process.
     """
-    logger.info(f"Classifying query: {query}")
+    return diskcache.Cache(CACHE_DIR, size_limit=CACHE_SIZE_LIMIT)
 
-    try:
-        system_list = [
-            {
-                "text": f"""Classify user input into:
-"Product" - for {os.getenv('PRODUCT_NAME')} specific queries
-"Generic" - for general questions.
-Only respond with category.
-Just Product or Generic, nothing more or less."""
-            }
-        ]
-
-        message_list = [{"role": "user", "content": [{"text": query}]}]
-
-        inf_params = {
-            "max_new_tokens": 10,
-            "top_p": 0.9,
-            "top_k": 20,
-            "temperature": 0.7
-        }
-        request_body = {
-            "schemaVersion": "messages-v1",
-            "messages": message_list,
-            "system": system_list,
-            "inferenceConfig": inf_params,
-        }
+response_cache = get_response_cache()
 
-        response = bedrock_runtime.invoke_model(
-            body=json.dumps(request_body).encode('utf-8'),
-            modelId=os.getenv('MODEL_ID'),
+def _cache_key(prefix: str, payload) -> str:
+    """
+    Build a response cache key from the model and a SHA-1 digest of the request payload.
+    """
+    digest = hashlib.sha1(orjson.dumps(payload)).hexdigest()
+    return f"{prefix}:{MODEL_ID}:{digest}"
+
+def _use_cache() -> bool:
+    """
+    Check if cached responses may be served (they can be bypassed from the sidebar for debugging).
+    """
+    return not st.session_state.get('bypass_cache', False)
+
+@st.cache_resource
+def _optimization_support() -> dict:
+    """
+    Process-wide record of whether Bedrock accepts latency-optimized inference and cache points.
+    Kept in the resource cache because module globals are reset on every Streamlit rerun.
+    """
+    return {'supported': True}
+
+# Terms Bedrock uses when it rejects the latency mode or a cache point
+OPTIMIZATION_ERROR_TERMS = ('latency', 'performanceconfig', 'cachepoint', 'cache point', 'caching')
+
+def _is_optimization_rejected(error: Exception) -> bool:
+    """
+    Check if a ValidationException is about the latency mode or prompt caching,
+    rather than an unrelated problem with the request.
+    """
+    message = str(error).lower()
+    return any(term in message for term in OPTIMIZATION_ERROR_TERMS)
+
+def _call_with_optimization(optimized_call, standard_call):
+    """
+    Make a Bedrock call with latency-optimized settings while they are supported.
+    After the first rejection, the standard settings are used for the rest of the process.
+    """
+    support = _optimization_support()
+    if support['supported']:
+        try:
+            return optimized_call()
+        except bedrock_runtime.exceptions.ValidationException as e:
+            if not _is_optimization_rejected(e):
+                raise
+            support['supported'] = False
+            logger.warning("Optimized invocation rejected, using standard settings from now on: %s", e)
+    return standard_call()
+
+def _invoke_nova(invoke, templates: tuple, query: str):
+    """
+    Call a Nova invoke API with latency-optimized inference and system prompt caching,
+    falling back to standard settings if the model or region does not support them.
+    'templates' is a pair built by '_request_templates'.
+    """
+    optimized_template, standard_template = templates
+    query_json = orjson.dumps(query)
+    return _call_with_optimization(
+        lambda: invoke(
+            body=optimized_template.replace(QUERY_SENTINEL, query_json, 1),
+            modelId=MODEL_ID,
+            accept="application/json",
+            contentType="application/json",
+            performanceConfigLatency=BEDROCK_LATENCY
+        ),
+        lambda: invoke(
+            body=standard_template.replace(QUERY_SENTINEL, query_json, 1),
+            modelId=MODEL_ID,
             accept="application/json",
             contentType="application/json"
         )
+    )
 
-        response_body = json.loads(response['body'].read())
-        logger.debug(f"Classification response: {json.dumps(response_body, indent=2)}")
-
-        content = response_body['output']['message']['content']
+@st.cache_data(ttl=3600, max_entries=1024, show_spinner=False)
+def _classify_normalized_query(query_norm: str) -> str:
+    """
+    Classify a normalized query using the Amazon Nova Chat model.
+    Results are cached per query; errors propagate so that failures are not cached.
+    """
+    response = _invoke_nova(bedrock_runtime.invoke_model, CLASSIFY_TEMPLATES, query_norm)
+
+    raw_body = response['body'].read()
+    response_body = orjson.loads(raw_body)
+    if logger.isEnabledFor(logging.DEBUG):
+        # Log the body as received rather than re-serializing the parsed response
+        logger.debug("Classification response: %s", raw_body.decode('utf-8', 'replace'))
+
+    content = response_body['output']['message']['content']
+    # Nova almost always returns a single text block
+    if len(content) == 1 and 'text' in content[0]:
+        result = content[0]['text']
+    else:
         result = ''.join(item['text'] for item in content if 'text' in item)
 
-        classification = "Product" if os.getenv('PRODUCT_NAME').lower() in result.lower() else "Generic"
-        logger.info(f"Query classified as: {classification}")
+    return "Product" if "product" in result.lower() else "Generic"
+
+def _is_ambiguous(query: str) -> bool:
+    """
+    Check if a query is short and relies on pronouns, so keyword matching is low-confidence.
+    """
+    return len(query.split()) <= AMBIGUOUS_MAX_WORDS and AMBIGUOUS_RE.search(query) is not None
+
+def _previous_category() -> Optional[str]:
+    """
+    Return the category of the last completed turn in the chat history, if any.
+    """
+    for entry in reversed(st.session_state.chat_history):
+        if entry['role'] == 'assistant':
+            return entry.get('category')
+    return None
+
+def _needs_llm_classification(query: str) -> bool:
+    """
+    Check if 'classify_query' will have to call Bedrock for this query.
+    Only ambiguous queries without a previous turn to refer back to are sent, so the
+    bare query carries all the context the classifier needs and its result can be cached.
+    """
+    return (CLASSIFY_FALLBACK_LLM and PRODUCT_RE.search(query) is None
+            and _is_ambiguous(query) and _previous_category() is None)
+
+def classify_query(query: str) -> str:
+    """
+    Classify if the query is product-specific or generic.
+    Queries mentioning the product (or an alias) are product queries. Ambiguous follow-ups
+    inherit the category of the previous turn; ambiguous first queries are sent to the
+    Amazon Nova Chat model when CLASSIFY_FALLBACK_LLM is enabled.
+    """
+    logger.info("Classifying query: %s", query)
+
+    if PRODUCT_RE.search(query):
+        logger.info("Query classified as: Product (keyword match)")
+        return "Product"
+
+    if _is_ambiguous(query):
+        previous_category = _previous_category()
+        if previous_category is not None:
+            logger.info("Query classified as: %s (follow-up to previous turn)", previous_category)
+            return previous_category
+
+    if not _needs_llm_classification(query):
+        logger.info("Query classified as: Generic (no keyword match)")
+        return "Generic"
+
+    try:
+        classification = _classify_normalized_query(query.strip().lower())
+        logger.info("Query classified as: %s", classification)
         return classification
 
     except Exception as e:
@@ -120,45 +406,277 @@ Just Product or Generic, nothing more or less."""
         st.error(error_msg)
         return "Generic"
 
-def get_kb_response(query: str) -> str:
+def _discard_stream(pending: Optional[Future]) -> None:
     """
-    Get a response using the Knowledge Base (via bedrock-agent's 'retrieve_and_generate').
+    Close a speculatively opened stream once its call completes, since it will not be rendered.
     """
-    logger.info(f"Getting knowledge base response for query: {query}")
-    try:
-        kb_response = bedrock_agent.retrieve_and_generate(
-            input={'text': query},
-            retrieveAndGenerateConfiguration={
-                'type': 'KNOWLEDGE_BASE',
-                'knowledgeBaseConfiguration': {
-                    'knowledgeBaseId': os.getenv('KNOWLEDGE_BASE_ID'),
-                    'modelArn': f"arn:aws:bedrock:{os.getenv('AWS_REGION')}::foundation-model/{os.getenv('MODEL_ID')}"
-                }
-            }
+    if pending is None:
+        return
+
+    def close(future: Future) -> None:
+        if not future.cancelled() and future.exception() is None:
+            future.result().close()
+
+    pending.add_done_callback(close)
+
+def _render_citation(context: Optional[str], source: Optional[str], source_label: str = "Source") -> None:
+    """
+    Render the knowledge base context and source for an answer.
+    'source_label' says whether the source was cited by the model or is only the top retrieval match.
+    """
+    if context is not None:
+        logger.info("Found context from source: %s", source)
+        # Knowledge base content is escaped so it cannot inject markup into the page
+        source_html = (f"<br><span style='color:#FFDA33'>{html.escape(source_label)}: </span>{html.escape(source)}"
+                       if source else "")
+        st.markdown(
+            f"<div><span style='color:#FFDA33'>Context: </span>{html.escape(context)}{source_html}</div>",
+            unsafe_allow_html=True
         )
+    else:
+        logger.warning("No specific context found in knowledge base response")
+        st.markdown("<span style='color:red'>No specific context found</span>", unsafe_allow_html=True)
 
-        logger.debug(f"Knowledge base response: {json.dumps(kb_response, indent=2)}")
-        answer = kb_response['output']['text']
-        logger.info("Successfully retrieved answer from knowledge base")
-        
-        if (len(kb_response['citations']) > 0 and
-            len(kb_response['citations'][0]['retrievedReferences']) > 0):
-            context = kb_response['citations'][0]['retrievedReferences'][0]['content']['text']
-            source = kb_response['citations'][0]['retrievedReferences'][0]['location']['s3Location']['uri']
-            logger.info(f"Found context from source: {source}")
-            st.markdown(
-                f"<span style='color:#FFDA33'>Context: </span>{context}",
-                unsafe_allow_html=True
-            )
-            st.markdown(
-                f"<span style='color:#FFDA33'>Source: </span>{source}",
-                unsafe_allow_html=True
+def _render_truncation_note(stop: dict) -> None:
+    """
+    Tell the user when a streamed answer was cut off at its output token cap.
+    """
+    if stop.get('reason') == 'max_tokens':
+        logger.warning("Answer truncated at the output token cap")
+        st.markdown("<span style='color:#FFDA33'>Answer truncated at the response length limit.</span>",
+                    unsafe_allow_html=True)
+
+def _passage_source(passage: dict) -> Optional[str]:
+    """
+    Return the URI, URL or ID of a retrieved passage for any data source type, if present.
+    The location holds one '<type>Location' entry, e.g. 's3Location' for type 'S3'.
+    """
+    location = passage.get('location', {})
+    location_type = location.get('type', '').lower()
+    for key, value in location.items():
+        if key.endswith('Location') and isinstance(value, dict) and key.lower().startswith(location_type):
+            return value.get('uri') or value.get('url') or value.get('id')
+    return None
+
+def _converse_stream_text(event_stream, stop: dict):
+    """
+    Yield text deltas from a Bedrock 'converse_stream' event stream, recording the stop reason in 'stop'.
+    """
+    for event in event_stream:
+        if 'contentBlockDelta' in event:
+            yield event['contentBlockDelta']['delta'].get('text', '')
+        elif 'messageStop' in event:
+            stop['reason'] = event['messageStop'].get('stopReason')
+        elif 'metadata' in event and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Converse stream metadata: %s",
+                orjson.dumps(event['metadata'], option=orjson.OPT_INDENT_2).decode()
             )
-        else:
-            logger.warning("No specific context found in knowledge base response")
-            st.markdown("<span style='color:red'>No specific context found</span>", unsafe_allow_html=True)
-            
-        return answer
+
+def _completed_turns() -> list:
+    """
+    Convert the chat history into Converse messages, keeping only user messages that were answered.
+    """
+    entries = list(st.session_state.chat_history)
+    messages = []
+    for entry, reply in zip(entries, entries[1:]):
+        if entry['role'] == 'user' and reply['role'] == 'assistant':
+            messages += [
+                {"role": "user", "content": [{"text": entry['content']}]},
+                {"role": "assistant", "content": [{"text": reply['content']}]}
+            ]
+    return messages
+
+def _converse_messages(query: str) -> list:
+    """
+    Build Converse messages from the most recent turns of the conversation followed by the query.
+    A cache point after the last completed turn lets Bedrock reuse the prefill of the history.
+    """
+    history = _completed_turns()[-2 * HISTORY_WINDOW_TURNS:] if HISTORY_WINDOW_TURNS > 0 else []
+    if history:
+        last_turn = history[-1]
+        history = history[:-1] + [{**last_turn, "content": [*last_turn["content"], CACHE_POINT]}]
+    return history + [{"role": "user", "content": [{"text": query}]}]
+
+def _converse_request(system_list: list, messages: list, max_tokens: int) -> dict:
+    """
+    Build the 'converse_stream' arguments for a prompt, conversation and output cap.
+    The same dict is hashed for the response cache, so any prompt or config change misses the cache.
+    """
+    return {
+        "modelId": MODEL_ID,
+        "system": system_list,
+        "messages": messages,
+        "inferenceConfig": {**CONVERSE_PARAMS, "maxTokens": max_tokens},
+        "additionalModelRequestFields": CONVERSE_ADDITIONAL_FIELDS
+    }
+
+def _open_converse_stream(request: dict):
+    """
+    Start a 'converse_stream' call built by '_converse_request' and return its event stream without consuming it.
+    Falls back to standard settings if latency-optimized inference or prompt caching is unsupported.
+    """
+    response = _call_with_optimization(
+        lambda: bedrock_runtime.converse_stream(**request, performanceConfig={"latency": BEDROCK_LATENCY}),
+        lambda: bedrock_runtime.converse_stream(**{
+            **request,
+            "system": _without_cache_points(request["system"]),
+            "messages": [{**message, "content": _without_cache_points(message["content"])}
+                         for message in request["messages"]]
+        })
+    )
+    return response['stream']
+
+def _retrieve_passages(query: str) -> list:
+    """
+    Retrieve the most relevant knowledge base passages for a query (retrieval only, no generation).
+    """
+    kb_response = bedrock_agent.retrieve(
+        knowledgeBaseId=KB_ID,
+        retrievalQuery={'text': query},
+        retrievalConfiguration=KB_RETRIEVAL_CONFIG
+    )
+    return kb_response['retrievalResults']
+
+def _kb_system_list(passages: list) -> list:
+    """
+    Build the system prompt for a product answer, with the retrieved passages after the cached instructions.
+    """
+    excerpts = "\n\n".join(
+        f"[{index}] {passage['content']['text']}" for index, passage in enumerate(passages, start=1)
+    )
+    return [
+        {"text": KB_SYSTEM_PROMPT},
+        CACHE_POINT,
+        {"text": f"Documentation excerpts:\n{excerpts}" if excerpts else "No documentation excerpts were found."}
+    ]
+
+def _kb_stream_text(event_stream, citations: list):
+    """
+    Yield answer text from a 'retrieve_and_generate_stream' event stream, collecting citation events.
+    """
+    for event in event_stream:
+        if 'output' in event:
+            yield event['output']['text']
+        elif 'citation' in event:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "Knowledge base citation event: %s",
+                    orjson.dumps(event['citation'], option=orjson.OPT_INDENT_2).decode()
+                )
+            citations.append(event['citation'])
+
+def _cited_reference(citations: list) -> Optional[dict]:
+    """
+    Return the first reference the model cited, if any.
+    """
+    for citation in citations:
+        references = (citation.get('retrievedReferences')
+                      or citation.get('citation', {}).get('retrievedReferences', []))
+        if references:
+            return references[0]
+    return None
+
+def _serve_cached_kb_response(cache_key: str) -> Optional[str]:
+    """
+    Render and return a cached knowledge base answer with its citation, if one is cached.
+    """
+    cached = response_cache.get(cache_key) if _use_cache() else None
+    if cached is None:
+        return None
+    logger.info("Serving knowledge base response from cache")
+    st.markdown(cached['answer'])
+    _render_truncation_note({'reason': cached.get('stop_reason')})
+    _render_citation(cached['context'], cached['source'], cached.get('source_label', "Source"))
+    return cached['answer']
+
+def _store_kb_response(cache_key: str, answer: str, context: Optional[str], source: Optional[str],
+                       source_label: str, stop: Optional[dict] = None) -> None:
+    """
+    Cache a knowledge base answer together with the citation and any truncation note rendered for it.
+    """
+    response_cache.set(
+        cache_key,
+        {
+            'answer': answer,
+            'context': context,
+            'source': source,
+            'source_label': source_label,
+            'stop_reason': (stop or {}).get('reason')
+        },
+        expire=CACHE_TTL
+    )
+
+def _stream_kb_answer(query: str) -> str:
+    """
+    Answer with a single 'retrieve_and_generate_stream' call and render the reference the model cited.
+    """
+    cache_key = _cache_key(f"kb:{KB_ID}", {'input': query, 'configuration': KB_CONFIG})
+    cached = _serve_cached_kb_response(cache_key)
+    if cached is not None:
+        return cached
+
+    kb_response = bedrock_agent.retrieve_and_generate_stream(
+        input={'text': query},
+        retrieveAndGenerateConfiguration=KB_CONFIG
+    )
+    citations = []
+    answer = st.write_stream(_kb_stream_text(kb_response['stream'], citations))
+    logger.info("Successfully retrieved answer from knowledge base")
+
+    # Citations arrive as separate stream events, so render them once the answer is complete
+    reference = _cited_reference(citations)
+    context = source = None
+    if reference is not None:
+        context = reference.get('content', {}).get('text')
+        source = _passage_source(reference)
+    _render_citation(context, source)
+
+    if answer:
+        _store_kb_response(cache_key, answer, context, source, "Source")
+    return answer
+
+def _stream_passage_answer(query: str, passages: list) -> str:
+    """
+    Answer from already retrieved passages with one Converse call, with recent turns as context.
+    The model does not report which passage it used, so the top retrieval match is shown as such.
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Knowledge base passages: %s", orjson.dumps(passages, option=orjson.OPT_INDENT_2).decode())
+
+    # The key covers the retrieved passages, prompt and output cap as well as the conversation
+    request = _converse_request(_kb_system_list(passages), _converse_messages(query), KB_MAX_TOKENS)
+    cache_key = _cache_key(f"kb:{KB_ID}", request)
+    cached = _serve_cached_kb_response(cache_key)
+    if cached is not None:
+        return cached
+
+    stop = {}
+    answer = st.write_stream(_converse_stream_text(_open_converse_stream(request), stop))
+    logger.info("Successfully generated answer from knowledge base passages")
+    _render_truncation_note(stop)
+
+    context = source = None
+    if passages:
+        context = passages[0].get('content', {}).get('text')
+        source = _passage_source(passages[0])
+    _render_citation(context, source, "Top match")
+
+    if answer:
+        _store_kb_response(cache_key, answer, context, source, "Top match", stop)
+    return answer
+
+def get_kb_response(query: str, pending: Optional[Future] = None) -> str:
+    """
+    Get a streamed response using the Knowledge Base.
+    If 'pending' is given, it is a future for passages already requested with '_retrieve_passages',
+    which are answered from directly; otherwise 'retrieve_and_generate_stream' does both in one call.
+    """
+    logger.info("Getting knowledge base response for query: %s", query)
+    try:
+        if pending is not None:
+            return _stream_passage_answer(query, pending.result())
+        return _stream_kb_answer(query)
 
     except Exception as e:
         error_msg = f"Knowledge base error: {str(e)}"
@@ -167,46 +685,48 @@ def get_kb_response(query: str) -> str:
         st.error(error_msg)
         return ""
 
-def get_generic_response(query: str) -> str:
+def _generic_max_tokens(query: str) -> int:
     """
-    Get a generic response using the Amazon Nova Chat model.
+    Pick the output token cap for a generic answer from the length of the query.
     """
-    logger.info(f"Getting generic response for query: {query}")
-    try:
-        system_list = [
-            {
-                "text": "You are a helpful assistant. Please provide a clear, professional answer."
-            }
-        ]
-
-        message_list = [{"role": "user", "content": [{"text": query}]}]
-
-        inf_params = {
-            "max_new_tokens": 500,
-            "top_p": 0.9,
-            "top_k": 20,
-            "temperature": 0.7
-        }
-        request_body = {
-            "schemaVersion": "messages-v1",
-            "messages": message_list,
-            "system": system_list,
-            "inferenceConfig": inf_params,
-        }
-
-        response = bedrock_runtime.invoke_model(
-            body=json.dumps(request_body).encode('utf-8'),
-            modelId=os.getenv('MODEL_ID'),
-            accept="application/json",
-            contentType="application/json"
-        )
+    return GENERIC_MAX_TOKENS_SHORT if len(query) < SHORT_QUERY_MAX_CHARS else GENERIC_MAX_TOKENS_LONG
 
-        response_body = json.loads(response['body'].read())
-        logger.debug(f"Generic response body: {json.dumps(response_body, indent=2)}")
+def _generic_request(query: str) -> dict:
+    """
+    Build the 'converse_stream' arguments for a generic answer to the query.
+    """
+    max_tokens = _generic_max_tokens(query)
+    return _converse_request(GENERIC_SYSTEM_LISTS[max_tokens], _converse_messages(query), max_tokens)
 
-        content = response_body['output']['message']['content']
-        result = ''.join(item['text'] for item in content if 'text' in item)
+def get_generic_response(query: str, pending: Optional[Future] = None) -> str:
+    """
+    Get a streamed generic response using the Amazon Nova Chat model, with recent turns as context.
+    If 'pending' is given, it is a future for a stream already opened from '_generic_request(query)'.
+    """
+    logger.info("Getting generic response for query: %s", query)
+    request = _generic_request(query)
+    # The key covers the whole request, so follow-ups are not answered out of context
+    # and prompt or token-cap changes are not served stale answers
+    cache_key = _cache_key("gen", request)
+    try:
+        cached = response_cache.get(cache_key) if _use_cache() else None
+        if cached is not None:
+            logger.info("Serving generic response from cache")
+            _discard_stream(pending)
+            st.markdown(cached['answer'])
+            _render_truncation_note({'reason': cached['stop_reason']})
+            return cached['answer']
+
+        event_stream = pending.result() if pending is not None else _open_converse_stream(request)
+
+        stop = {}
+        result = st.write_stream(_converse_stream_text(event_stream, stop))
         logger.info("Successfully generated generic response")
+        _render_truncation_note(stop)
+        # Answers cut off at the cap are cached too, since an identical request hits the same cap;
+        # the stop reason is kept so the truncation note is shown again
+        if result:
+            response_cache.set(cache_key, {'answer': result, 'stop_reason': stop.get('reason')}, expire=CACHE_TTL)
         return result
 
     except Exception as e:
@@ -216,8 +736,8 @@ def get_generic_response(query: str) -> str:
         st.error(error_msg)
         return ""
 
-if query := st.chat_input(f"Ask me anything about {os.getenv('PRODUCT_NAME')}..."):
-    logger.info(f"New query received: {query}")
+if query := st.chat_input(f"Ask me anything about {PRODUCT_NAME}..."):
+    logger.info("New query received: %s", query)
 
     with st.chat_message("user"):
         st.markdown(query)
@@ -225,34 +745,45 @@ if query := st.chat_input(f"Ask me anything about {os.getenv('PRODUCT_NAME')}...
     logger.debug("User message added to chat history")
 
     with st.chat_message("assistant"):
+        pending_passages = pending_generic = None
+        if SPECULATIVE and _needs_llm_classification(query):
+            # Both answer paths overlap the classification round-trip instead of waiting for it; local
+            # classification is instant, so otherwise only the matching path is called afterwards.
+            # Worker threads only call Bedrock; all rendering stays on the script thread.
+            executor = ThreadPoolExecutor(max_workers=2)
+            pending_passages = executor.submit(_retrieve_passages, query)
+            pending_generic = executor.submit(_open_converse_stream, _generic_request(query))
+            executor.shutdown(wait=False)
+            logger.info("Started speculative retrieval and generic generation during classification")
+
         with st.spinner("Processing..."):
             category = classify_query(query)
-            st.session_state.chat_history.append(
-                {"role": "system", "content": f"Classified as: {category}"}
-            )
-            logger.info(f"Query classification added to chat history: {category}")
-
-            if category == "Product":
-                logger.info("Processing product-specific query")
-                response = get_kb_response(query)
-            else:
-                logger.info("Processing generic query")
-                response = get_generic_response(query)
-
-            if response:
-                st.markdown(response)
-                st.session_state.chat_history.append({"role": "assistant", "content": response})
-                logger.info("Assistant response added to chat history")
-            else:
-                logger.warning("No response generated")
+        logger.info("Processing query classified as: %s", category)
+
+        # Responses are streamed into the chat message as they are generated
+        if category == "Product":
+            logger.info("Processing product-specific query")
+            response = get_kb_response(query, pending_passages)
+            _discard_stream(pending_generic)
+        else:
+            logger.info("Processing generic query")
+            response = get_generic_response(query, pending_generic)
+
+        if response:
+            # The category is kept with the turn so ambiguous follow-ups can inherit it
+            st.session_state.chat_history.append({"role": "assistant", "content": response, "category": category})
+            logger.info("Assistant response added to chat history")
+        else:
+            logger.warning("No response generated")
 
 with st.sidebar:
     st.header("Configuration")
-    st.write("Region:", os.getenv('AWS_REGION'))
-    st.write("Model:", os.getenv('MODEL_ID'))
-    st.write("Product:", os.getenv('PRODUCT_NAME'))
+    st.write("Region:", AWS_REGION)
+    st.write("Model:", MODEL_ID)
+    st.write("Product:", PRODUCT_NAME)
+    st.toggle("Bypass cache", key="bypass_cache", help="Always call Bedrock instead of serving cached answers")
     
     if st.button("Clear Chat"):
         logger.info("Clearing chat history")
-        st.session_state.chat_history = []
+        st.session_state.chat_history = deque(maxlen=2 * HISTORY_TURNS)
         st.rerun()
\ No newline at end of file